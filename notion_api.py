@@ -1,8 +1,12 @@
 import os
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import httpx
 from notion_client import Client
-from notion_client.errors import APIResponseError
-from utils import retry
+from notion_client.errors import APIResponseError, HTTPResponseError, RequestTimeoutError
+from utils import retry, retry_after, RateLimiter, RETRY_STATUSES
 
 NOTION_TOKEN = os.environ.get("NOTION_TOKEN", "")
 DATABASE_ID = os.environ.get("NOTION_DATABASE_ID", "")
@@ -10,37 +14,118 @@ DATABASE_ID = os.environ.get("NOTION_DATABASE_ID", "")
 if not NOTION_TOKEN or not DATABASE_ID:
     raise SystemExit("Missing NOTION_TOKEN or NOTION_DATABASE_ID env vars.")
 
-client = Client(auth=NOTION_TOKEN)
+# Notion allows an average of ~3 requests/second per integration. The limiter
+# paces the upsert requests; the workers only overlap their network waits.
+# A short burst is allowed so writes resume at once after the workers idle
+# (e.g. while waiting on a slow Canvas course).
+UPSERT_WORKERS = 3
+_NOTION_RATE = RateLimiter(3, burst=5)
+# How many times a write is re-sent after Notion answers 429 rate_limited
+RATE_LIMIT_RETRIES = 5
+
+# Explicit keep-alive pool (notion_client drives httpx under the hood) so the
+# concurrent upserts reuse warm TLS connections instead of opening new ones.
+# HTTP/2 lets those concurrent requests share a single multiplexed connection.
+_HTTPX = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=8, max_keepalive_connections=8, keepalive_expiry=60),
+)
+client = Client(auth=NOTION_TOKEN, client=_HTTPX)
+
+# Failures worth retrying on reads and idempotent writes: HTTP errors (utils.retry
+# narrows these to 429/5xx), SDK timeouts and httpx connection-level errors
+_TRANSIENT = (HTTPResponseError, RequestTimeoutError, httpx.TransportError)
+
+def _error_code(e) -> str:
+    """Lower-cased Notion error code of an APIResponseError ('' if absent)."""
+    return (getattr(e, "code", None) or "").lower()
+
+def _paced(fn, idempotent=False, **kwargs):
+    """Call a Notion endpoint within the shared rate limit, waiting out 429 responses.
+
+    Idempotent calls (pages.update) are also retried on 5xx, timeouts and
+    connection errors. Creates are not: a lost response could mean the page exists.
+    """
+    delay = 1.0
+    for _ in range(RATE_LIMIT_RETRIES):
+        _NOTION_RATE.acquire()
+        try:
+            return fn(**kwargs)
+        except _TRANSIENT as e:
+            status = getattr(e, "status", None)
+            transient = status is None or status in RETRY_STATUSES
+            if _error_code(e) != "rate_limited" and not (idempotent and transient):
+                raise
+            time.sleep(retry_after(e) or delay)
+            delay *= 2
+    _NOTION_RATE.acquire()
+    return fn(**kwargs)
 
 # ---------- Helpers for schema detection ----------
 
+_SCHEMA = {}  # the run's database object: first retrieve, then each update's response
+
+@retry(_TRANSIENT, tries=4, delay=1.0, backoff=2.0)
 def retrieve_db():
-    return client.databases.retrieve(database_id=DATABASE_ID)
+    """Fetch the database schema once per run; call _update_db() to change it."""
+    if "db" not in _SCHEMA:
+        _SCHEMA["db"] = client.databases.retrieve(database_id=DATABASE_ID)
+    return _SCHEMA["db"]
+
+@lru_cache(maxsize=1)
+def _option_names():
+    """Existing option names per select/multi_select property, built once per schema fetch."""
+    return {
+        name: frozenset(o["name"] for o in p[p["type"]]["options"])
+        for name, p in retrieve_db()["properties"].items()
+        if p["type"] in ("select", "multi_select")
+    }
 
+@retry(_TRANSIENT, tries=4, delay=1.0, backoff=2.0)
+def _update_db(properties):
+    """Patch the database schema. Notion answers with the updated database, which
+    becomes the cached schema, so no follow-up retrieve is needed."""
+    _SCHEMA["db"] = client.databases.update(database_id=DATABASE_ID, properties=properties)
+    _option_names.cache_clear()
+
+class _AlnumOnly(dict):
+    """str.translate table keeping [a-z0-9] and deleting everything else (memoized per code point)."""
+    def __missing__(self, cp):
+        keep = cp if (48 <= cp <= 57 or 97 <= cp <= 122) else None
+        self[cp] = keep
+        return keep
+
+_ALNUM_ONLY = _AlnumOnly()
+
+@lru_cache(maxsize=1024)
 def _normalize(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").strip().lower())
+    return (s or "").strip().lower().translate(_ALNUM_ONLY)
 
-def _first_title_prop(db):
+def _names_by_type(db):
+    """Group property names by type in a single pass over the schema (schema order kept)."""
+    by_type = {}
     for name, prop in db["properties"].items():
-        if prop["type"] == "title":
-            return name
-    raise SystemExit("No title property found in this Notion database.")
+        by_type.setdefault(prop["type"], []).append(name)
+    return by_type
 
-def _status_prop_and_options(db):
-    for name, prop in db["properties"].items():
-        if prop["type"] == "status":
-            opts = [o["name"] for o in prop["status"]["options"]]
-            return name, opts
-    return None, []
-
-def _checkbox_named(db, want_name):
-    prop = db["properties"].get(want_name)
-    if prop and prop["type"] == "checkbox":
-        return want_name
-    for name, p in db["properties"].items():
-        if p["type"] == "checkbox":
-            return name
-    return None
+def _first_of_type(by_type, kind):
+    names = by_type.get(kind)
+    return names[0] if names else None
+
+def _first_title_prop(by_type):
+    name = _first_of_type(by_type, "title")
+    if name is None:
+        raise SystemExit("No title property found in this Notion database.")
+    return name
+
+def _status_prop_and_options(db, by_type):
+    name = _first_of_type(by_type, "status")
+    if name is None:
+        return None, []
+    return name, [o["name"] for o in db["properties"][name]["status"]["options"]]
+
+def _checkbox_named(db, by_type, want_name):
+    return _prop_if_type(db, want_name, {"checkbox"}) or _first_of_type(by_type, "checkbox")
 
 def _prop_if_type(db, name, want_types):
     prop = db["properties"].get(name)
@@ -48,29 +133,23 @@ def _prop_if_type(db, name, want_types):
         return name
     return None
 
-def _find_multi_select(db, preferred_names=("Tags", "Class", "Teacher")):
+def _find_multi_select(db, by_type, preferred_names=("Tags", "Class", "Teacher")):
     for nm in preferred_names:
-        if nm in db["properties"] and db["properties"][nm]["type"] == "multi_select":
-            return nm
-    for nm, p in db["properties"].items():
-        if p["type"] == "multi_select":
+        if _prop_if_type(db, nm, {"multi_select"}):
             return nm
-    return None
+    return _first_of_type(by_type, "multi_select")
 
 def ensure_canvas_id_property():
     db = retrieve_db()
     prop = db["properties"].get("Canvas ID")
     if not prop or prop.get("type") != "number":
-        client.databases.update(
-            database_id=DATABASE_ID,
-            properties={"Canvas ID": {"number": {}}},
-        )
+        _update_db({"Canvas ID": {"number": {}}})
 
 def ensure_schema():
     ensure_canvas_id_property()
 
-def status_label_mapping(db):
-    prop, options = _status_prop_and_options(db)
+def status_label_mapping(db, by_type=None):
+    prop, options = _status_prop_and_options(db, by_type or _names_by_type(db))
     if not prop:
         return None, {"not_started": None, "started": None, "completed": None}
 
@@ -100,10 +179,11 @@ def get_flexible_schema():
     Supports BOTH a real Notion date prop and a text date prop.
     """
     db = retrieve_db()
-    title_prop = _first_title_prop(db)
+    by_type = _names_by_type(db)  # one pass; the lookups below are dict hits
+    title_prop = _first_title_prop(by_type)
 
-    status_prop, status_labels = status_label_mapping(db)
-    done_checkbox = _checkbox_named(db, "Done")  # optional
+    status_prop, status_labels = status_label_mapping(db, by_type)
+    done_checkbox = _checkbox_named(db, by_type, "Done")  # optional
 
     class_prop    = _prop_if_type(db, "Class",    {"multi_select"})
     teacher_prop  = _prop_if_type(db, "Teacher",  {"multi_select"})
@@ -112,31 +192,15 @@ def get_flexible_schema():
 
     # Recognize common date property names
     date_candidates = ["Date", "Due date", "Due Date", "Calendar Date", "Calendar"]
-    due_date_prop_date = None       # Notion 'date' type prop (for calendar)
-    due_date_prop_text = None       # rich_text type prop where you want "MM/DD/YYYY"
-
-    for nm in date_candidates:
-        if _prop_if_type(db, nm, {"date"}):
-            due_date_prop_date = nm
-            break
-
-    if not due_date_prop_date:
-        # Even if we have a 'date', we still check for a text date column to fill "MM/DD/YYYY"
-        pass
-
-    # Find any text prop among candidates (or any rich_text) to write MM/DD/YYYY
-    for nm in date_candidates:
-        if _prop_if_type(db, nm, {"rich_text"}):
-            due_date_prop_text = nm
-            break
-    if not due_date_prop_text:
-        # As a last resort, any rich_text field can be used for the string date if present
-        for nm, p in db["properties"].items():
-            if p["type"] == "rich_text":
-                due_date_prop_text = nm
-                break
-
-    tags_prop = _prop_if_type(db, "Tags", {"multi_select"}) or _find_multi_select(db)
+    due_date_prop_date = next((nm for nm in date_candidates if _prop_if_type(db, nm, {"date"})), None)
+
+    # Even if we have a 'date', we still look for a text date column to fill "MM/DD/YYYY":
+    # a candidate name first, then (as a last resort) any rich_text field
+    due_date_prop_text = next((nm for nm in date_candidates if _prop_if_type(db, nm, {"rich_text"})), None)
+    if due_date_prop_text is None:
+        due_date_prop_text = _first_of_type(by_type, "rich_text")
+
+    tags_prop = _find_multi_select(db, by_type)
 
     return {
         "title_prop": title_prop,
@@ -154,60 +218,73 @@ def get_flexible_schema():
 
 # ---------- Option management (only when the prop exists) ----------
 
-def _ensure_select_options_for(db, prop_name, want_names, kind):
+def _missing_options_patch(db, prop_name, want_names, kind):
+    """Return the schema patch adding *want_names* to *prop_name*, or None if nothing is missing."""
+    if not any(want_names):
+        return None
     prop = db["properties"].get(prop_name)
     if not prop or prop["type"] != kind:
-        return
-    have = {opt["name"] for opt in prop[kind]["options"]}
-    missing = [n for n in want_names if n and n not in have]
+        return None
+    have = _option_names()[prop_name]
+    # dict.fromkeys drops duplicate names (e.g. the Tags roll-up) while keeping order
+    missing = [n for n in dict.fromkeys(want_names) if n and n not in have]
     if not missing:
-        return
+        return None
     new_opts = prop[kind]["options"] + [{"name": n} for n in missing]
-    client.databases.update(
-        database_id=DATABASE_ID,
-        properties={prop_name: {kind: {"options": new_opts}}},
-    )
+    return {kind: {"options": new_opts}}
 
 def ensure_taxonomy(class_names=(), teacher_names=(), type_names=("Assignment","Quiz","Test"), priority=("High","Medium","Low")):
     db = retrieve_db()
-    if "Class"   in db["properties"] and db["properties"]["Class"]["type"]   == "multi_select":
-        _ensure_select_options_for(db, "Class",   class_names, "multi_select")
-    if "Teacher" in db["properties"] and db["properties"]["Teacher"]["type"] == "multi_select":
-        _ensure_select_options_for(db, "Teacher", teacher_names, "multi_select")
-    if "Type"    in db["properties"] and db["properties"]["Type"]["type"]    == "select":
-        _ensure_select_options_for(db, "Type",    type_names,   "select")
-    if "Priority"in db["properties"] and db["properties"]["Priority"]["type"]== "select":
-        _ensure_select_options_for(db, "Priority",priority,     "select")
-
-    if "Tags" in db["properties"] and db["properties"]["Tags"]["type"] == "multi_select":
-        _ensure_select_options_for(
-            db, "Tags",
-            list(set(list(class_names)+list(teacher_names)+list(type_names)+list(priority))),
-            "multi_select"
-        )
+    wanted = [
+        ("Class",    class_names,   "multi_select"),
+        ("Teacher",  teacher_names, "multi_select"),
+        ("Type",     type_names,    "select"),
+        ("Priority", priority,      "select"),
+        ("Tags",     [*class_names, *teacher_names, *type_names, *priority], "multi_select"),
+    ]
+
+    # Collect every property's missing options and send them in a single schema update
+    updates = {}
+    for prop_name, names, kind in wanted:
+        patch = _missing_options_patch(db, prop_name, names, kind)
+        if patch:
+            updates[prop_name] = patch
+    if updates:
+        _update_db(updates)
 
 # ---------- Query helpers for de-dup ----------
 
-@retry(tries=4, delay=1.0, backoff=2.0)
-def query_by_canvas_id(canvas_id: int):
-    try:
-        return client.databases.query(
-            database_id=DATABASE_ID,
-            filter={"property": "Canvas ID", "number": {"equals": canvas_id}},
-            page_size=3,
-        )
-    except APIResponseError as e:
-        msg = (getattr(e, "body", {}) or {}).get("message", "").lower()
-        if "could not find property" in msg or "validation_error" in (getattr(e, "code", "") or "").lower():
-            ensure_canvas_id_property()
-            return client.databases.query(
-                database_id=DATABASE_ID,
-                filter={"property": "Canvas ID", "number": {"equals": canvas_id}},
-                page_size=3,
-            )
-        raise
+@retry(_TRANSIENT, tries=4, delay=1.0, backoff=2.0)
+def _query_db(**query):
+    """databases.query within the shared rate limit (each retry takes its own slot)."""
+    _NOTION_RATE.acquire()
+    return client.databases.query(**query)
+
+_INDEX_LOCK = threading.Lock()  # guards canvas_page_index() additions from upsert_pages workers
+
+@lru_cache(maxsize=1)
+def canvas_page_index():
+    """
+    Scan the database once and return {canvas_id: page} for every page that has a Canvas ID.
+    Replaces a databases.query per assignment with ceil(pages/100) queries per run.
+    Pages created during the run are added by upsert_page.
+    """
+    index = {}
+    query = {
+        "database_id": DATABASE_ID,
+        "filter": {"property": "Canvas ID", "number": {"is_not_empty": True}},
+        "page_size": 100,
+    }
+    while True:
+        res = _query_db(**query)
+        for page in res.get("results", []):
+            cid = (page["properties"].get("Canvas ID") or {}).get("number")
+            if cid is not None:
+                index.setdefault(cid, page)
+        if not res.get("has_more"):
+            return index
+        query["start_cursor"] = res.get("next_cursor")
 
-@retry(tries=3, delay=0.8, backoff=1.8)
 def query_by_title_and_date(
     title_prop: str,
     due_date_prop_date: str | None,
@@ -229,12 +306,12 @@ def query_by_title_and_date(
         f = filters[0]
     else:
         f = {"and": filters}
-    return client.databases.query(database_id=DATABASE_ID, filter=f, page_size=3)
+    return _query_db(database_id=DATABASE_ID, filter=f, page_size=3)
 
 # ---------- Date normalization ----------
 
 def _is_null_date(val) -> bool:
-    if not isinstance(val, dict):
+    if not isinstance(val, dict) or "date" not in val:
         return False
     d = val.get("date")
     if d is None:
@@ -260,6 +337,26 @@ def _drop_null_dates_for_create(props: dict) -> dict:
         clean[k] = v
     return clean
 
+# ---------- Change detection ----------
+
+def _comparable(value):
+    """Reduce a property value (as we write it, or as Notion returns it) to a plain comparable form."""
+    kind = value.get("type") or next(iter(value), None)
+    v = value.get(kind)
+    if kind in ("title", "rich_text"):
+        return "".join(p.get("plain_text") or (p.get("text") or {}).get("content", "") for p in v or [])
+    if kind in ("select", "status"):
+        return (v or {}).get("name")
+    if kind == "multi_select":
+        return [o.get("name") for o in v or []]
+    if kind == "date":
+        return (v or {}).get("start")
+    return v
+
+def _props_equal(remote: dict, local: dict) -> bool:
+    """True when every property we are about to write already has that value on the page."""
+    return all(k in remote and _comparable(remote[k]) == _comparable(v) for k, v in local.items())
+
 # ---------- Upsert with anti-dup ----------
 
 def upsert_page(
@@ -271,20 +368,25 @@ def upsert_page(
     due_date_prop_date=None,
     due_str_iso=None,
     due_date_prop_text=None,
-    due_str_mdy=None
+    due_str_mdy=None,
+    create_props=None,
 ):
     """
     De-dup order:
-      1) Canvas ID match
+      1) Canvas ID match (from canvas_page_index)
       2) Title + (Date or DateString) match → update that page and attach Canvas ID
+    create_props are only written when a new page is created (e.g. its initial Status).
     """
+    index = canvas_page_index()
+
     # 1) Try by Canvas ID
-    res = query_by_canvas_id(canvas_id)
-    results = res.get("results", [])
-    if results:
-        page_id = results[0]["id"]
+    page = index.get(canvas_id)
+    if page:
+        page_id = page["id"]
+        if _props_equal(page.get("properties", {}), props):
+            return page_id, "unchanged"
         props = _normalize_date_for_update(props)
-        client.pages.update(page_id=page_id, properties=props)
+        _paced(client.pages.update, idempotent=True, page_id=page_id, properties=props)
         return page_id, "updated"
 
     # 2) Fallback: Title + (Date or TextDate)
@@ -297,26 +399,45 @@ def upsert_page(
             td_results = res_td.get("results", [])
             if td_results:
                 page_id = td_results[0]["id"]
+                with _INDEX_LOCK:
+                    index[canvas_id] = td_results[0]
+                if _props_equal(td_results[0].get("properties", {}), props):
+                    return page_id, "unchanged"
                 props = _normalize_date_for_update(props)
-                client.pages.update(page_id=page_id, properties=props)
+                _paced(client.pages.update, idempotent=True, page_id=page_id, properties=props)
                 return page_id, "updated"
         except APIResponseError:
             pass
 
     # 3) Create new
-    clean = _drop_null_dates_for_create(props)
-    page = client.pages.create(parent={"database_id": DATABASE_ID}, properties=clean)
+    clean = _drop_null_dates_for_create({**props, **(create_props or {})})
+    page = _paced(client.pages.create, parent={"database_id": DATABASE_ID}, properties=clean)
+    with _INDEX_LOCK:
+        index[canvas_id] = page
     return page["id"], "created"
 
+def upsert_pages(items):
+    """
+    Upsert many pages concurrently.
+    *items* is an iterable of (canvas_id, props, kwargs) where kwargs are the
+    keyword arguments accepted by upsert_page. Returns results in input order.
+    Each item is handed to a worker as soon as *items* produces it, so a lazy
+    iterable overlaps its own production with the writes.
+    """
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as ex:
+        return list(ex.map(lambda it: upsert_page(it[0], it[1], **it[2]), items))
+
+_ACCESS_ERRORS = {
+    "unauthorized": "NOTION_TOKEN invalid. Paste the exact ntn_/secret_ token (no quotes/spaces) into repo secret NOTION_TOKEN.",
+    "object_not_found": "NOTION_DATABASE_ID is wrong/inaccessible. Open the DB as a page and copy the 32-char ID from the URL.",
+    "restricted_resource": "Invite the integration to the DB: Share → Invite → your integration → Can edit.",
+}
+
 def verify_access():
     try:
-        client.databases.retrieve(database_id=DATABASE_ID)
+        retrieve_db()
     except APIResponseError as e:
-        code = (getattr(e, "code", "") or "").lower()
-        if code == "unauthorized":
-            raise SystemExit("NOTION_TOKEN invalid. Paste the exact ntn_/secret_ token (no quotes/spaces) into repo secret NOTION_TOKEN.")
-        if code in ("object_not_found",):
-            raise SystemExit("NOTION_DATABASE_ID is wrong/inaccessible. Open the DB as a page and copy the 32-char ID from the URL.")
-        if code in ("restricted_resource",):
-            raise SystemExit("Invite the integration to the DB: Share → Invite → your integration → Can edit.")
+        msg = _ACCESS_ERRORS.get(_error_code(e))
+        if msg:
+            raise SystemExit(msg)
         raise
@@ -1,67 +1,77 @@
 import os
-from datetime import datetime, timezone
-from dateutil import parser as dtparser
-from dateutil.relativedelta import relativedelta
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import re
 
-from canvas_api import list_courses, list_assignments, me_profile
+from canvas_api import list_courses, list_assignments_many, me_profile
 from notion_api import (
+    canvas_page_index,
     ensure_schema,
     ensure_taxonomy,
-    upsert_page,
+    upsert_pages,
     verify_access,
     get_flexible_schema,
 )
 
 # ----- Helpers -----
 
+_TEST_RE = re.compile(r"\b(?:exam|midterm|final|test)\b", re.IGNORECASE)
+
+# Each due date is parsed by the window filter and again when props are built, and
+# a course's assignments often share due times; datetimes are immutable, so cache them
+@lru_cache(maxsize=4096)
 def parse_iso(iso):
     if not iso:
         return None
     try:
-        return dtparser.isoparse(iso).astimezone(timezone.utc)
-    except Exception:
+        # Canvas emits strict RFC 3339 (trailing "Z"). fromisoformat only accepts
+        # "Z" from Python 3.11, so spell it as +00:00 to keep 3.10 working too
+        dt = datetime.fromisoformat(iso.replace("Z", "+00:00"))
+    except (AttributeError, TypeError, ValueError):
         return None
+    # An offset-less timestamp is taken as UTC rather than the runner's local zone
+    return dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+# Priority thresholds as timedeltas, so the per-assignment check is a plain comparison
+_HIGH_WITHIN = timedelta(days=2)
+_MEDIUM_WITHIN = timedelta(days=5)
+
+# Priority/Type values come from a fixed set of names, so their option objects and
+# select payloads are built once and shared by every page (nothing mutates them)
+_OPTIONS = {n: {"name": n} for n in ("High", "Medium", "Low", "Assignment", "Quiz", "Test")}
+_SELECT_PAYLOADS = {n: {"select": opt} for n, opt in _OPTIONS.items()}
+_CHECKBOX_PAYLOADS = {True: {"checkbox": True}, False: {"checkbox": False}}
 
-def to_days_left(due_at):
+def compute_priority(due_at, now):
     if not due_at:
-        return None
-    now = datetime.now(timezone.utc)
-    delta = due_at - now
-    return delta.total_seconds() / 86400.0
-
-def compute_priority(due_at):
-    days = to_days_left(due_at)
-    if days is None:
-        return {"name": "Low"}  # default when no due date
-    if days <= 2:
-        return {"name": "High"}
-    if days <= 5:
-        return {"name": "Medium"}
-    return {"name": "Low"}
+        return _OPTIONS["Low"]  # default when no due date
+    left = due_at - now
+    if left <= _HIGH_WITHIN:
+        return _OPTIONS["High"]
+    if left <= _MEDIUM_WITHIN:
+        return _OPTIONS["Medium"]
+    return _OPTIONS["Low"]
 
 def infer_type(assignment):
-    name = (assignment.get("name") or "").lower()
     if assignment.get("quiz_id"):
-        return {"name": "Quiz"}
-    if re.search(r"\b(exam|midterm|final|test)\b", name):
-        return {"name": "Test"}
-    return {"name": "Assignment"}
+        return _OPTIONS["Quiz"]
+    if _TEST_RE.search(assignment.get("name") or ""):
+        return _OPTIONS["Test"]
+    return _OPTIONS["Assignment"]
 
 def to_iso_date(dt):
     """Return 'YYYY-MM-DD' for Notion date property."""
     if not dt:
         return None
-    return dt.date().isoformat()
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
 
 def to_mdy_date(dt):
     """Return 'MM/DD/YYYY' text string."""
     if not dt:
         return None
-    m = f"{dt.month:02d}"
-    d = f"{dt.day:02d}"
-    y = f"{dt.year:04d}"
-    return f"{m}/{d}/{y}"
+    return f"{dt.month:02d}/{dt.day:02d}/{dt.year:04d}"
 
 def status_payload(status_prop, status_labels, submitted_at, default_to="not_started"):
     if not status_prop or not status_labels:
@@ -71,21 +81,51 @@ def status_payload(status_prop, status_labels, submitted_at, default_to="not_sta
         return {}
     return {"status": {"name": label}}
 
-def window_bounds():
-    """Return (start_utc, end_utc) for +/- 5 months around now."""
+def shift_months(dt, months):
+    """Move *dt* by whole calendar months, clamping the day to the target month's length."""
+    y, m = divmod(dt.month - 1 + months, 12)
+    year, month = dt.year + y, m + 1
+    return dt.replace(year=year, month=month, day=min(dt.day, calendar.monthrange(year, month)[1]))
+
+def window_bounds(now=None):
+    """Return (start_utc, end_utc) for +/- 5 months around *now* (default: the current time)."""
     months = 5
-    now = datetime.now(timezone.utc)
-    start = now - relativedelta(months=months)
-    end = now + relativedelta(months=months)
+    if now is None:
+        now = datetime.now(timezone.utc)
+    start = shift_months(now, -months)
+    end = shift_months(now, months)
     return start, end
 
+def _teacher_names(teachers):
+    """Display names of a course's teachers, first occurrence of each (co-teachers can share one)."""
+    return list(dict.fromkeys(
+        disp
+        for t in teachers
+        if (disp := t.get("display_name") or t.get("short_name") or t.get("name"))
+    ))
+
+def fetch_courses():
+    # Touch Canvas first to fail early if credentials bad
+    _ = me_profile()
+    return list_courses()
+
 # ----- Main sync -----
 
 def run():
+    # 0) Canvas and Notion setup are independent: fetch courses in the background
+    #    while the Notion database is validated and inspected
+    background = ThreadPoolExecutor(max_workers=2)
+    courses_future = background.submit(fetch_courses)
+
     # 1) Validate access & required schema
     verify_access()
     ensure_schema()
 
+    # The Canvas ID → page index is only needed by the upserts; scan the database
+    # in the background while Canvas is fetched and props are built
+    index_future = background.submit(canvas_page_index)
+    background.shutdown(wait=False)
+
     # 2) Discover DB shape (title, status, tags, etc.)
     schema = get_flexible_schema()
     title_prop          = schema["title_prop"]
@@ -100,18 +140,50 @@ def run():
     due_date_prop_text  = schema["due_date_prop_text"]   # rich_text for MM/DD/YYYY
     tags_prop           = schema["tags_prop"]
 
-    # 3) Touch Canvas to fail early if credentials bad
-    _ = me_profile()
+    # 3) Wait for the Canvas course list (re-raises any Canvas error here)
+    courses = courses_future.result()
+
+    # 4) Determine the +/- 5-month window and log it
+    now = datetime.now(timezone.utc)  # one clock read for the window and every priority
+    start_window, end_window = window_bounds(now)
+    print(f"[sync] Window: {start_window.isoformat()}  →  {end_window.isoformat()}")
 
-    # 4) Build taxonomy (for options if those props exist)
-    courses = list_courses()
-    class_names, teacher_names = [], []
+    # Canvas timestamps are fixed-width UTC ("2024-05-01T23:59:00Z"), which sort the
+    # same as strings as they do as datetimes; bounds truncated to the second keep
+    # the string check conservative, and the parsed comparison has the final say
+    start_str = start_window.strftime("%Y-%m-%dT%H:%M:%SZ")
+    end_str = end_window.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def wanted(a):
+        # --- RULE #1: skip deleted items and items with no due date ---
+        if a.get("deleted"):
+            return False
+        due_str = a.get("due_at")
+        if not due_str:
+            return False
+        # Reject far-off items without parsing them
+        if len(due_str) == 20 and due_str[-1] == "Z" and not (start_str <= due_str <= end_str):
+            return False
+        due_at = parse_iso(due_str)
+        # Only keep items due within +/- 5 months of now
+        return due_at is not None and start_window <= due_at <= end_window
+
+    # 5) Start every course's assignment fetch concurrently; the requests are independent,
+    #    and neither they nor the filter depend on the taxonomy below, so Canvas is
+    #    fetched while Notion's options are updated.
+    #    Out-of-window assignments are filtered while streaming, never kept in memory.
+    assignments_by_course = list_assignments_many((c.get("id") for c in courses), keep=wanted)
+
+    # 6) Build taxonomy (for options if those props exist). dicts serve as
+    #    insertion-ordered sets, so each name is passed to ensure_taxonomy once.
+    class_names, teacher_names = {}, {}
+    course_records = []  # (class name, instructor names) per course, reused by the props loop
     for c in courses:
         cname = c.get("name")
-        if cname: class_names.append(cname)
-        for t in (c.get("teachers") or []):
-            disp = t.get("display_name") or t.get("short_name") or t.get("name")
-            if disp: teacher_names.append(disp)
+        if cname: class_names[cname] = None
+        tnames = _teacher_names(c.get("teachers") or [])
+        course_records.append((cname, tnames))
+        teacher_names.update(dict.fromkeys(tnames))
 
     ensure_taxonomy(
         class_names=class_names,
@@ -120,108 +192,122 @@ def run():
         priority=("High","Medium","Low"),
     )
 
-    # 5) Determine the +/- 5-month window and log it
-    start_window, end_window = window_bounds()
-    print(f"[sync] Window: {start_window.isoformat()}  →  {end_window.isoformat()}")
+    # 7) Build props for assignments within the window (DUE DATE REQUIRED), lazily:
+    #    each course's items are produced as soon as its assignments arrive
 
-    # 6) Upsert assignments within the window (DUE DATE REQUIRED)
-    for c in courses:
-        cid = c.get("id")
-        cname = c.get("name")
-        tnames = []
-        for t in (c.get("teachers") or []):
-            disp = t.get("display_name") or t.get("short_name") or t.get("name")
-            if disp: tnames.append(disp)
-
-        for a in list_assignments(cid):
-            if a.get("deleted"):
-                continue
-
-            # --- RULE #1: skip if no due date ---
-            due_at = parse_iso(a.get("due_at"))
-            if not due_at:
-                continue
-
-            # Only keep items due within +/- 5 months of now
-            if not (start_window <= due_at <= end_window):
-                continue
-
-            title_text = a.get("name", "Untitled Assignment")
-            due_iso = to_iso_date(due_at)   # 'YYYY-MM-DD' for Notion date prop
-            due_mdy = to_mdy_date(due_at)   # 'MM/DD/YYYY' text string
-
-            a_type = infer_type(a)
-            priority = compute_priority(due_at)
-            sub = a.get("submission") or {}
-            submitted_at = sub.get("submitted_at")
-
-            props = {}
-
-            # Title
-            props[title_prop] = {"title": [{"text": {"content": title_text}}]}
-
-            # Date (both kinds if present): date prop gets ISO; text prop gets MM/DD/YYYY
-            if due_date_prop_date and due_iso:
-                props[due_date_prop_date] = {"date": {"start": due_iso}}
-            if due_date_prop_text and due_mdy:
-                props[due_date_prop_text] = {"rich_text": [{"text": {"content": due_mdy}}]}
-
-            # Status
-            st = status_payload(status_prop, status_labels, submitted_at)
-            if st:
-                props[status_prop] = st["status"]
-
-            # Done checkbox mirrors Completed
-            if done_prop:
-                props[done_prop] = {"checkbox": bool(submitted_at)}
-
-            # Priority
-            if priority_prop:
-                props[priority_prop] = {"select": priority}
-            elif tags_prop and priority and priority.get("name"):
-                props.setdefault(tags_prop, {"multi_select": []})
-                props[tags_prop]["multi_select"].append({"name": priority["name"]})
-
-            # Type
-            if type_prop:
-                props[type_prop] = {"select": a_type}
-            elif tags_prop:
-                props.setdefault(tags_prop, {"multi_select": []})
-                props[tags_prop]["multi_select"].append({"name": a_type["name"]})
+    # Status only depends on whether there's a submission: build both payloads once
+    status_submitted = status_payload(status_prop, status_labels, True)
+    status_open = status_payload(status_prop, status_labels, None)
 
-            # Class / Teacher
-            added_tags = []
-            if class_prop:
-                props[class_prop] = {"multi_select": [{"name": cname}]} if cname else {"multi_select": []}
-            else:
-                if cname and tags_prop:
-                    added_tags.append({"name": cname})
+    # Cross-listed sections can return the same assignment under several courses;
+    # write each Canvas ID once (two workers racing on it could also create twins)
+    seen_ids = set()
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "duplicate": 0}
 
+    def pending():
+        for (cname, tnames), assignments in zip(course_records, assignments_by_course):
+            # Class / Teacher are the same for every assignment in the course: build
+            # those payloads (or their Tags fallback) once and share them
+            course_props, course_tags = {}, []
+            if class_prop:
+                course_props[class_prop] = {"multi_select": [{"name": cname}]} if cname else {"multi_select": []}
+            elif cname and tags_prop:
+                course_tags.append({"name": cname})
             if teacher_prop:
-                props[teacher_prop] = {"multi_select": [{"name": t} for t in tnames]}
-            else:
-                if tags_prop:
-                    for t in tnames:
-                        added_tags.append({"name": t})
-
-            if tags_prop and added_tags:
-                props.setdefault(tags_prop, {"multi_select": []})
-                props[tags_prop]["multi_select"].extend(added_tags)
-
-            # Canvas ID (Number)
-            props["Canvas ID"] = {"number": a.get("id")}
-
-            # Upsert with duplicate protection: CanvasID → Title + Date(Text) fallback
-            upsert_page(
-                a.get("id"),
-                props,
-                title_prop=title_prop,
-                title_text=title_text,
-                due_date_prop_date=due_date_prop_date,
-                due_str_iso=due_iso,
-                due_date_prop_text=due_date_prop_text,
-                due_str_mdy=due_mdy,
-            )
+                course_props[teacher_prop] = {"multi_select": [{"name": t} for t in tnames]}
+            elif tags_prop:
+                course_tags.extend({"name": t} for t in tnames)
+
+            for a in assignments:
+                if a.get("id") in seen_ids:
+                    counts["duplicate"] += 1
+                    continue
+                seen_ids.add(a.get("id"))
+
+                due_at = parse_iso(a.get("due_at"))
+                title_text = a.get("name", "Untitled Assignment")
+                due_iso = to_iso_date(due_at)   # 'YYYY-MM-DD' for Notion date prop
+                due_mdy = to_mdy_date(due_at)   # 'MM/DD/YYYY' text string
+
+                a_type = infer_type(a)
+                priority = compute_priority(due_at, now)
+                try:
+                    submitted_at = a["submission"]["submitted_at"]
+                except (KeyError, TypeError):  # no submission included, or it's null
+                    submitted_at = None
+
+                # Start from the course's shared Class/Teacher payloads
+                props = dict(course_props)
+                tags = []
+
+                # Title
+                props[title_prop] = {"title": [{"text": {"content": title_text}}]}
+
+                # Date (both kinds if present): date prop gets ISO; text prop gets MM/DD/YYYY
+                if due_date_prop_date and due_iso:
+                    props[due_date_prop_date] = {"date": {"start": due_iso}}
+                if due_date_prop_text and due_mdy:
+                    props[due_date_prop_text] = {"rich_text": [{"text": {"content": due_mdy}}]}
+
+                # Status: a submission sets it; otherwise only a new page gets the open
+                # label, so a status set by hand in Notion is kept
+                st = status_submitted if submitted_at else status_open
+                create_props = {}
+                if st and submitted_at:
+                    props[status_prop] = st
+                elif st:
+                    create_props[status_prop] = st
+
+                # Done checkbox mirrors Completed
+                if done_prop:
+                    props[done_prop] = _CHECKBOX_PAYLOADS[bool(submitted_at)]
+
+                # Priority
+                if priority_prop:
+                    props[priority_prop] = _SELECT_PAYLOADS[priority["name"]]
+                elif tags_prop:
+                    tags.append(priority)
+
+                # Type
+                if type_prop:
+                    props[type_prop] = _SELECT_PAYLOADS[a_type["name"]]
+                elif tags_prop:
+                    tags.append(a_type)
+
+                # Class / Teacher fall back to Tags when they have no column of their own.
+                # If Tags itself resolved to the Class/Teacher column, that payload wins.
+                tags.extend(course_tags)
+                if tags:
+                    props.setdefault(tags_prop, {"multi_select": tags})
+
+                # Canvas ID (Number)
+                props["Canvas ID"] = {"number": a.get("id")}
+
+                # Queue the upsert; duplicate protection is CanvasID → Title + Date(Text) fallback
+                yield (
+                    a.get("id"),
+                    props,
+                    dict(
+                        title_prop=title_prop,
+                        title_text=title_text,
+                        due_date_prop_date=due_date_prop_date,
+                        due_str_iso=due_iso,
+                        due_date_prop_text=due_date_prop_text,
+                        due_str_mdy=due_mdy,
+                        create_props=create_props,
+                    ),
+                )
+
+    # 8) Write everything to Notion with bounded concurrency. Wait for the
+    #    Canvas ID → page index first so the workers share one scan; courses still
+    #    loading are written as they arrive rather than after the last one.
+    index_future.result()
+    results = upsert_pages(pending())
+    for _, action in results:
+        counts[action] += 1
+    print(f"[sync] Notion: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged")
+    if counts["duplicate"]:
+        print(f"[sync] Skipped {counts['duplicate']} duplicate Canvas ID(s)")
 
 if __name__ == "__main__":
     run()
@@ -1,8 +1,42 @@
 import os
+import random
+import threading
 import time
 from functools import wraps
 
-def retry(exceptions=(Exception,), tries=3, delay=1.0, backoff=2.0):
+# HTTP statuses worth retrying; anything else (400, 401, 404, ...) will fail again
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def _response_of(e):
+    """(status, headers) of the HTTP response carried by *e*, or (None, None).
+
+    Understands requests' HTTPError (e.response) and notion_client's
+    HTTPResponseError (e.status / e.headers).
+    """
+    resp = getattr(e, "response", None)
+    status = getattr(e, "status", None) or getattr(resp, "status_code", None)
+    headers = getattr(e, "headers", None) or getattr(resp, "headers", None)
+    return status, headers
+
+def retry_after(e):
+    """Seconds the server asked us to wait via Retry-After, or None."""
+    _, headers = _response_of(e)
+    try:
+        return float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def retry(exceptions=(OSError,), tries=3, delay=1.0, backoff=2.0):
+    """Retry the wrapped call on *exceptions* with jittered exponential backoff.
+
+    The default covers network failures (requests' exceptions are OSErrors);
+    callers using other clients pass their own transient error types, so
+    programming errors are never slept on and retried.
+
+    Errors that carry an HTTP status are only retried for 429/5xx, waiting at
+    least as long as the server's Retry-After; errors without one (connection
+    resets, timeouts) are always retried.
+    """
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
@@ -10,8 +44,12 @@ def retry(exceptions=(Exception,), tries=3, delay=1.0, backoff=2.0):
             while _tries > 1:
                 try:
                     return fn(*args, **kwargs)
-                except exceptions:
-                    time.sleep(_delay)
+                except exceptions as e:
+                    status, _ = _response_of(e)
+                    if status is not None and status not in RETRY_STATUSES:
+                        raise
+                    # Jitter keeps concurrent workers from retrying in lockstep
+                    time.sleep(max(_delay * (0.5 + random.random()), retry_after(e) or 0))
                     _tries -= 1
                     _delay *= backoff
             return fn(*args, **kwargs)
@@ -29,3 +67,26 @@ def get_env(*names, default=""):
         if v:
             return v
     return default
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to at most *rate* per second.
+
+    Up to *burst* calls may go out back to back after an idle stretch; beyond
+    that, callers are held to the steady rate.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self._slack = (burst - 1) * self.interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            due = max(now, self._next)
+            wait = due - now - self._slack
+            self._next = due + self.interval
+        if wait > 0:
+            time.sleep(wait)